@@ -27,24 +27,78 @@ import struct  # For packing and unpacking binary data into specific formats
 import sys  # Provides access to system-specific parameters
 import threading  # For creating concurrent threads
 import time  # For handling time-based events
+import math  # For rounding the jitter buffer's ordering window up to whole packets
 import argparse  # For parsing command-line arguments
-from collections import deque  # For using a deque, ideal for jitter buffer
+import ctypes  # For pointing sendmmsg at the header and capture buffers
+import selectors  # For waiting on the UDP socket (epoll on Linux) until packets arrive or the client stops
+import itertools  # For counting sequence numbers
+import queue  # For handing recorded audio from the recording thread to the sender thread
+from collections import deque  # Bounded ring for log messages from the audio threads
+import udp_batch  # Batched UDP sends and receives (sendmmsg/recvmmsg) with fallbacks for other platforms
+import framing  # Length-prefixed TCP control messages, shared with the server
 
 # constants
 SAMPLE_RATE = 44100  # Audio sample rate in Hz
 CHANNELS = 1  # Mono audio
-CHUNK_SIZE = 882  # Each audio chunk has 882 samples
-BYTES_PER_PACKET = CHUNK_SIZE * 2  # 16-bit (2 bytes per sample), mono (1 channel) audio
-PACKET_SIZE = 2200  # Size of each UDP packet, slightly larger than the audio packet size for headers
+PATH_MTU = 1500  # Largest IP packet the network carries unfragmented; raise to 9000 where every hop supports jumbo frames
+IP_UDP_HEADER_SIZE = 28  # IPv4 (20 bytes) plus UDP (8 bytes) headers in front of every audio packet
+HEADER_SIZE = 4  # Size of the sequence number header at the start of every audio packet
+BYTES_PER_SAMPLE = 1  # 8-bit μ-law, mono (1 channel) audio on the wire
+CHUNK_SIZE = (PATH_MTU - IP_UDP_HEADER_SIZE - HEADER_SIZE) // BYTES_PER_SAMPLE  # Samples per packet, as many as fill one MTU (1468, ~33 ms)
+BYTES_PER_PACKET = CHUNK_SIZE * BYTES_PER_SAMPLE  # Audio bytes in every packet
+PCM_BYTES_PER_PACKET = CHUNK_SIZE * 2  # One packet decoded to 16-bit samples for the output stream
+PACKET_SIZE = HEADER_SIZE + BYTES_PER_PACKET  # Every packet on the wire, EOT included, is exactly this long (1472 bytes)
+RECV_BUFFER_SIZE = PACKET_SIZE + 1  # Size of the UDP receive buffer, one byte larger than PACKET_SIZE so oversized packets show up as such
 EOT_SEQ_NUM = 99999999  # Special sequence number to indicate EOT packet
 JITTER_BUFFER_SIZE = 8  # The size of the jitter buffer (how many packets to store before playing)
-PLAYBACK_INTERVAL_MS = 10  # Time (in ms) between audio playback iterations
+JITTER_RING_SLOTS = 16  # Packet slots in the jitter buffer's ring, a power of two at least twice JITTER_BUFFER_SIZE
+PLAYBACK_BATCH = 4  # Most packets handed to the output stream in one write; more means fewer wake-ups but more queued audio
+JITTER_BUFFER_MIN_SIZE = 1  # Smallest ordering window: always give a reordered packet one packet time to catch up
+FRAME_TIME = CHUNK_SIZE / SAMPLE_RATE  # Seconds of audio carried by each packet
+LAG_EWMA_WEIGHT = 1 / 16  # Weight of each new lag sample in the smoothed lag (same gain as RTP interarrival jitter)
+WATERMARK_FACTOR = 2  # The ordering window covers this many times the smoothed lag
+WINDOW_SHRINK_INTERVAL = 0.2  # Seconds of steady arrivals needed before the ordering window shrinks by one packet
 TCP_PORT = 8888  # TCP port for the handshake with the server
 UDP_SERVER_PORT = 9999  # UDP port to receive and send audio data
 TIMEOUT = 2  # Timeout in seconds for waiting on network operations
 MAX_RETRIES = 3  # Maximum retries for the TCP handshake with the server
+RETRY_BACKOFF = 0.5  # Seconds to wait before the second handshake attempt, doubled before every further attempt
+HELLO_PORT = struct.Struct(">I")  # The client's UDP port, right after the 5-byte b"HELLO" tag of a HELLO message
 HEARTBEAT_INTERVAL = 30  # Interval (in seconds) for sending heartbeat packets to check server availability
-SILENCE_THRESHOLD = 0.01  # Amplitude threshold to warn if the audio input is too quiet (for debug)
+RTT_EWMA_WEIGHT = 0.1  # Weight of each new heartbeat round trip in the smoothed round-trip time
+HEADER = struct.Struct(">I")  # Precompiled big-endian sequence number header, so the format is parsed only once
+LOG_RING_SIZE = 1024  # Log messages kept while waiting to be printed; the oldest are dropped if printing falls behind
+LOG_FLUSH_INTERVAL = 0.1  # Seconds between prints of queued log messages
+STATS_INTERVAL = 1.0  # Seconds between playback summaries, so nothing is logged per packet
+MAX_BATCH = 8  # Maximum number of audio packets handed to the kernel in a single sendmmsg call
+RECV_BATCH = 32  # Maximum number of audio packets read from the kernel in a single recvmmsg call
+CAPTURE_SLOTS = 16  # Number of preallocated blocks in the capture ring (~530 ms of audio), must be a power of two
+CAPTURE_MASK = CAPTURE_SLOTS - 1  # Turns a running block count into a capture ring slot
+IP_MTU_DISCOVER = 10  # Linux socket option for path MTU discovery (not exported by the socket module)
+IP_PMTUDISC_DO = 2  # Always set Don't Fragment, so a packet larger than the path MTU fails instead of fragmenting
+ULAW_BIAS = 0x84  # Added to every magnitude before μ-law encoding, so each segment starts on a power of two
+ULAW_CLIP = 32635  # Largest magnitude μ-law can encode (before the bias)
+SILENCE = bytes(PCM_BYTES_PER_PACKET)  # One packet's worth of int16 silence
+EOT_PACKET = HEADER.pack(EOT_SEQ_NUM) + b"\xff" * BYTES_PER_PACKET  # EOT header followed by a packet of μ-law silence
+UDP_SNDBUF_SIZE = 4 * 1024 * 1024  # Requested UDP send buffer; Linux caps it at net.core.wmem_max (raise with sysctl net.core.wmem_max=12582912)
+UDP_RCVBUF_SIZE = 4 * 1024 * 1024  # Requested UDP receive buffer; Linux caps it at net.core.rmem_max (raise with sysctl net.core.rmem_max=12582912)
+
+"""
+Builds the G.711 μ-law encoder and decoder lookup tables
+"""
+def build_ulaw_tables():
+    samples = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32)  # Every int16 value, in uint16 index order
+    sign = np.where(samples < 0, 0x80, 0)
+    magnitude = np.minimum(np.abs(samples), ULAW_CLIP) + ULAW_BIAS
+    exponent = np.frexp(magnitude)[1] - 8  # Segment number: position of the highest set bit above bit 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F  # Four bits of the magnitude below the highest set bit
+    encode = (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF  # μ-law bytes are sent inverted
+    decoded = (((codes & 0x0F) << 3) + ULAW_BIAS << ((codes >> 4) & 0x07)) - ULAW_BIAS
+    decode = np.where(codes & 0x80, -decoded, decoded).astype(np.int16)
+    return encode, decode
+
+ULAW_ENCODE, ULAW_DECODE = build_ulaw_tables()  # 64 KiB encoder table and 256-entry decoder table
 
 """
 JitterBuffer class is used to reorder out-of-sequence packets to ensure smooth playback
@@ -54,45 +108,92 @@ class JitterBuffer:
     """
     initialization function
     """
-    def __init__(self, max_size):
+    def __init__(self, max_size, min_size=JITTER_BUFFER_MIN_SIZE, frame_time=FRAME_TIME, slots=JITTER_RING_SLOTS):
         # Initialize jitter buffer with maximum capacity
-        self.buffer = deque(maxlen=max_size)  # A deque automatically discards old items once the max size is exceeded
-        self.max_size = max_size  # Max buffer size
-        self.expected_seq_num = None  # Initially no expected sequence number
+        self.slots = slots  # Packets the ring can hold
+        self.mask = slots - 1  # Turns a sequence number into a slot index
+        self.audio = memoryview(bytearray(slots * BYTES_PER_PACKET))  # Preallocated audio storage
+        self.views = [self.audio[i * BYTES_PER_PACKET:(i + 1) * BYTES_PER_PACKET] for i in range(slots)]  # One view per slot
+        self.seq_nums = [None] * slots  # Sequence number held by each slot, None if it is empty
+        self.arrivals = [0.0] * slots  # When each slot's packet arrived
+        self.max_size = max_size  # Largest the ordering window may grow
+        self.min_size = min_size  # Smallest the ordering window may shrink
+        self.frame_time = frame_time  # Seconds of audio per packet
+        # Written only by the producer
+        self.window = min_size  # Current ordering window, in packets
+        self.newest_seq_num = None  # Highest sequence number received so far
+        self.lag_ewma = 0.0  # Smoothed lag between when packets arrive and when they were expected, in packets
+        self.last_arrival = None  # (seq_num, arrival_time) of the previous packet, the reference for the next lag
+        self.last_resize = 0.0  # When the ordering window last changed size
+        # Written only by the consumer
+        self.watermark = None  # Lowest sequence number that can still be played
 
     """
-    Adds a new packet to the jitter buffer after verifying its sequence number
+    Adapts the ordering window to how irregularly packets arrive
+    """
+    def update_window(self, seq_num, now):
+        if self.last_arrival is not None:
+            last_seq_num, last_time = self.last_arrival
+            # Packets are sent one frame apart, so any other spacing on arrival is network jitter
+            lag = abs((now - last_time) / self.frame_time - (seq_num - last_seq_num))
+            self.lag_ewma += (lag - self.lag_ewma) * LAG_EWMA_WEIGHT
+        self.last_arrival = (seq_num, now)
+        target = min(self.max_size, max(self.min_size, math.ceil(WATERMARK_FACTOR * self.lag_ewma)))
+        if target > self.window:  # Grow straight away, waiting would mean dropouts
+            self.window = target
+            self.last_resize = now
+        elif target < self.window and now - self.last_resize >= WINDOW_SHRINK_INTERVAL:  # Shrink gradually to avoid stutter
+            self.window -= 1
+            self.last_resize = now
+
+    """
+    Copies a new packet into the jitter buffer after verifying its sequence number. Called by the receive thread only
     """
     def add_packet(self, seq_num, audio_data):
-        # If the packet's sequence number is too old, discard it
-        if self.expected_seq_num is not None and seq_num < self.expected_seq_num - self.max_size:
+        now = time.monotonic()
+        slot = seq_num & self.mask
+        watermark = self.watermark
+        # If the packet is below the watermark, playback has already moved past it, so discard it
+        if watermark is not None and seq_num < watermark:
+            return False
+        if self.seq_nums[slot] == seq_num:  # Avoid adding packets that have already been received
+            return False
+        newest = self.newest_seq_num
+        if newest is not None and seq_num <= newest - self.slots:  # Too late, its slot now belongs to a newer packet
             return False
-        packet = (seq_num, audio_data)  # Create a tuple of sequence number and audio data
-        if not self.buffer:  # If the buffer is empty, simply add the first packet
-            self.buffer.append(packet)
-            self.expected_seq_num = seq_num  # Set the expected sequence number for the next packet
-            return True
-        # Check for duplicates: avoid adding packets that have already been received
-        for existing_seq, _ in self.buffer:
-            if seq_num == existing_seq:
-                return False
-        temp = list(self.buffer)  # Convert buffer to a list for sorting
-        temp.append(packet)  # Add the new packet to the list
-        temp.sort(key=lambda x: x[0])  # Sort the packets by their sequence number
-        self.buffer.clear()  # Clear the current buffer
-        for item in temp[-self.max_size:]:  # Refill the buffer with sorted packets, limited by max_size
-            self.buffer.append(item)
+        self.update_window(seq_num, now)
+        self.seq_nums[slot] = None  # Retract whatever older packet held the slot before overwriting it
+        self.views[slot][:] = audio_data  # Copy the audio into its slot
+        self.arrivals[slot] = now
+        self.seq_nums[slot] = seq_num  # Publish the packet to the consumer, last
+        if self.newest_seq_num is None or seq_num > self.newest_seq_num:
+            self.newest_seq_num = seq_num
         return True
 
     """
-    Retrieves the next packet from the buffer, ordered by sequence number
+    Copies the next packet in sequence order into `out` and returns its sequence number, or None if nothing is ready
     """
-    def get_packet(self):
-        if not self.buffer:  # Return None if the buffer is empty
-            return None, None
-        seq_num, audio_data = self.buffer.popleft()  # Pop the first packet
-        self.expected_seq_num = seq_num + 1  # Update the expected sequence number for the next packet
-        return seq_num, audio_data  # Return the sequence number and audio data of the next packet
+    def read_packet(self, out):
+        newest = self.newest_seq_num
+        if newest is None:  # Nothing received yet
+            return None
+        start = newest - self.slots + 1  # Anything older has been overwritten
+        if self.watermark is not None and self.watermark > start:
+            start = self.watermark
+        now = time.monotonic()
+        window = self.window
+        for seq_num in range(start, newest + 1):  # Find the oldest packet still in the ring
+            slot = seq_num & self.mask
+            if self.seq_nums[slot] != seq_num:  # Missing, either lost or not here yet
+                continue
+            if newest - seq_num < window and now - self.arrivals[slot] < window * self.frame_time:
+                return None  # Still inside the ordering window, an earlier packet may yet arrive
+            out[:] = self.views[slot]  # Copy the audio out
+            if self.seq_nums[slot] != seq_num:  # Overwritten by a newer packet while copying, so it is gone
+                continue
+            self.watermark = seq_num + 1  # Anything older that turns up from now on is too late
+            return seq_num
+        return None  # Return None if the buffer is empty
 
 """
 The Client class handles everything from TCP handshakes to recording and playback
@@ -106,45 +207,168 @@ class Client:
         # Initialize the client with essential properties
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP socket for audio data transmission
         self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow reuse of local addresses
+        self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SNDBUF_SIZE)  # Room for send bursts so the kernel does not drop them
+        self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF_SIZE)  # Room to absorb bursts while playback is busy
+        # The kernel silently caps both sizes, so report what was actually granted
+        print(f"UDP buffers: send {self.udp_sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)} bytes, "
+              f"receive {self.udp_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes")
+        if sys.platform.startswith("linux"):
+            self.udp_sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)  # Never fragment audio packets
         self.udp_sock.bind(("0.0.0.0", udp_port))  # Bind the UDP socket to the specified port
-        self.udp_sock.settimeout(1.0)  # Set socket timeout to 1 second for network operations
+        self.udp_sock.connect((server_ip, UDP_SERVER_PORT))  # Fix the destination once so sends skip address handling
+        self.udp_sock.setblocking(False)  # Reads wait in the selector instead, so a read never blocks or times out
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()  # Writing to _wakeup_send wakes the receive thread
+        self._wakeup_recv.setblocking(False)  # Drained after every wake-up without waiting for more
+        self._selector = selectors.DefaultSelector()  # Waits for audio packets or a wake-up
+        self._selector.register(self.udp_sock, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
         self.server_ip = server_ip  # IP address of the server
         self.target_ip = target_ip  # IP address of the target client
         self.udp_port = udp_port  # Port number for sending/receiving audio
         self.jitter_buffer = JitterBuffer(JITTER_BUFFER_SIZE)  # Initialize jitter buffer to handle packet reordering
         self.is_running = True  # Flag to control whether the client is running or not
         self.is_recording = True  # Flag to indicate if the client is still recording
+        self._stopped = threading.Event()  # Set to wake the main thread when the client should shut down
         self.eot_received = False  # Flag to indicate if End of Transmission (EOT) signal has been received
-        self.sequence_number = 0  # Initial sequence number for the audio packets
+        self.sequence_numbers = itertools.count()  # Sequence numbers for the audio packets, counted in C starting at 0
+        self.tcp_sock = None  # TCP connection to the server, kept open after the handshake for heartbeats
+        self.rtt = None  # Smoothed round-trip time to the server in seconds, measured by the heartbeats
+        self._send_hdrs = bytearray(MAX_BATCH * HEADER_SIZE)  # Preallocated sequence number headers for one batch of packets
+        self._send_hdr_views = [memoryview(self._send_hdrs)[i * HEADER_SIZE:(i + 1) * HEADER_SIZE] for i in range(MAX_BATCH)]  # One view per header slot
+        self._pack_header = HEADER.pack_into  # Bound once so the send path does no attribute lookups
+        self._send_msgs = None  # mmsghdr array for sendmmsg, built when recording starts
+        self._recv_batch = udp_batch.ReceiveBatch(self.udp_sock, RECV_BATCH, RECV_BUFFER_SIZE)  # Preallocated storage for one batch of received packets
+        self._capture_queue = queue.SimpleQueue()  # Wakes the sender thread when the recording thread adds a block
+        self._capture_ring = np.empty((CAPTURE_SLOTS, CHUNK_SIZE), dtype=np.uint8)  # Preallocated μ-law blocks written by the recording thread
+        self._capture_views = [memoryview(block) for block in self._capture_ring]  # Byte views of each block for sending
+        self._capture_head = 0  # Number of blocks sent so far, only advanced by the sender thread
+        self._capture_tail = 0  # Number of blocks recorded so far, only advanced by the recording thread
+        self._play_ulaw = np.empty(PLAYBACK_BATCH * BYTES_PER_PACKET, dtype=np.uint8)  # Preallocated batch of μ-law packets from the jitter buffer
+        self._play_buf = memoryview(self._play_ulaw)  # Byte view of the batch for read_packet
+        self._play_pcm = np.empty(PLAYBACK_BATCH * CHUNK_SIZE, dtype=np.int16)  # The same batch decoded for one output write
+        self._log_ring = deque(maxlen=LOG_RING_SIZE)  # Messages from the audio threads, printed by print_log
+
+    """
+    Queues a message for print_log, so the audio threads never block on stdout
+    """
+    def log(self, fmt, *args):
+        self._log_ring.append((fmt, args))  # Atomic and never blocks; a full ring drops its oldest message
+
+    """
+    Prints the messages queued by log
+    """
+    def print_log(self):
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)  # Print in batches, so the audio threads never wait on this thread
+            while self._log_ring:
+                fmt, args = self._log_ring.popleft()
+                print(fmt.format(*args))
+
+    """
+    Builds the mmsghdr array used by sendmmsg
+    """
+    def prepare_batch_send(self):
+        if not udp_batch.HAVE_SENDMMSG:  # Nothing to prepare when sendmmsg is unavailable
+            return
+        hdr_base = udp_batch.buffer_address(self._send_hdrs)  # Address of the header storage
+        self._capture_addrs = [block.ctypes.data for block in self._capture_ring]  # Address of every capture block
+        self._send_iov = (udp_batch.IoVec * (2 * MAX_BATCH))()
+        self._send_msgs = (udp_batch.MMsgHdr * MAX_BATCH)()
+        for i in range(MAX_BATCH):
+            self._send_iov[2 * i].iov_base = hdr_base + i * HEADER_SIZE  # Each packet owns one header slot
+            self._send_iov[2 * i].iov_len = HEADER_SIZE
+            self._send_iov[2 * i + 1].iov_len = BYTES_PER_PACKET  # Audio pointer is filled in per send
+            hdr = self._send_msgs[i].msg_hdr  # msg_name stays NULL, the socket is connected to the server
+            hdr.msg_iov = ctypes.pointer(self._send_iov[2 * i])
+            hdr.msg_iovlen = 2
+
+    """
+    Waits for packets and reads every queued one, returning their lengths
+    """
+    def receive_batch(self):
+        events = self._selector.select()  # Sleep until a packet arrives or stop() writes to the wake-up socket
+        ready = False
+        for key, _ in events:
+            if key.fileobj is self.udp_sock:
+                ready = True
+            else:  # Consume the wake-up, so it does not fire again on the next select
+                try:
+                    self._wakeup_recv.recv(4096)
+                except BlockingIOError:
+                    pass
+        if not ready:
+            return []
+        return self._recv_batch.receive()
+
+    """
+    Sends one packet per capture slot in `slots` and returns how many were sent
+    """
+    def send_batch(self, slots):
+        for i in range(len(slots)):
+            self._pack_header(self._send_hdrs, i * HEADER_SIZE, next(self.sequence_numbers))  # Sequence number header
+        if self._send_msgs is None:  # No sendmmsg on this platform, send the packets one at a time
+            for i, slot in enumerate(slots):
+                parts = [self._send_hdr_views[i], self._capture_views[slot]]
+                if hasattr(self.udp_sock, "sendmsg"):  # Gather header and audio in the kernel where possible
+                    self.udp_sock.sendmsg(parts)
+                else:
+                    self.udp_sock.send(b"".join(parts))
+            return len(slots)
+        for i, slot in enumerate(slots):
+            self._send_iov[2 * i + 1].iov_base = self._capture_addrs[slot]  # Point the packet's audio at its capture block
+        return udp_batch.send_messages(self.udp_sock, self._send_msgs, len(slots))  # Send the whole batch in one system call
+
+    """
+    Asks the kernel to acknowledge server messages right away instead of delaying the ACK
+    """
+    def quickack(self, tcp_sock):
+        if hasattr(socket, "TCP_QUICKACK"):
+            tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+    """
+    Receives one control message from the server, b"" if it closed the connection, and re-arms quick ACKs
+    """
+    def recv_message(self, tcp_sock):
+        message = framing.recv_message(tcp_sock)
+        self.quickack(tcp_sock)
+        return message
 
     """
     Performs the TCP handshake with the server to initiate communication
     """
     def tcp_handshake(self):
-        hello_packet = b"HELLO" + struct.pack(">I", self.udp_port) + self.target_ip.encode()  # Create a hello packet with UDP port and target IP
+        hello_packet = b"HELLO" + HELLO_PORT.pack(self.udp_port) + self.target_ip.encode()  # Create a hello packet with UDP port and target IP
         for attempt in range(MAX_RETRIES):  # Retry up to MAX_RETRIES times if the handshake fails
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))  # Back off so a struggling server is not hammered
+            tcp_sock = None
             try:
                 print(f"Attempting TCP handshake with {self.server_ip}:{TCP_PORT} (Attempt {attempt + 1})...")
                 tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Create a TCP socket
+                tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send the small control messages immediately
+                tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)  # Let the kernel notice a dead connection between heartbeats
                 tcp_sock.settimeout(TIMEOUT)  # Set a timeout for the connection
                 tcp_sock.connect((self.server_ip, TCP_PORT))  # Connect to the server on the specified TCP port
-                tcp_sock.send(hello_packet)  # Send the hello packet
-                response = tcp_sock.recv(1024)  # Wait for a response from the server
+                self.quickack(tcp_sock)
+                framing.send_message(tcp_sock, hello_packet)  # Send the hello packet
+                response = self.recv_message(tcp_sock)  # Wait for a response from the server
                 if response == b"WELCOME":  # Server accepted the handshake
                     print("Handshake successful!")
+                    self.tcp_sock = tcp_sock  # Keep the connection open for heartbeats
                     return True
                 elif response == b"FULL":  # Server is full, reject the connection
                     print("Server is full.")
                     return False
                 else:  # Unexpected response from server
                     print("Unexpected response during handshake.")
-            except (socket.timeout, ConnectionRefusedError) as e:  # Catch connection errors and timeouts
+            except OSError as e:  # Catch connection errors and timeouts
                 print(f"Handshake failed: {e}")
             finally:
-                try:
-                    tcp_sock.close()  # Close the TCP socket after each attempt
-                except:
-                    pass
+                if tcp_sock is not self.tcp_sock:  # Close the TCP socket unless it is kept for heartbeats
+                    try:
+                        tcp_sock.close()
+                    except:
+                        pass
         print("Handshake failed after maximum retries.")  # Max retries exceeded
         return False
 
@@ -154,80 +378,128 @@ class Client:
     def send_heartbeat(self):
         while self.is_running:
             try:
-                tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Create a TCP socket
-                tcp_sock.settimeout(TIMEOUT)  # Set a timeout for the connection
-                tcp_sock.connect((self.server_ip, TCP_PORT))  # Connect to the server
-                tcp_sock.send(b"HEARTBEAT")  # Send a heartbeat message
-                response = tcp_sock.recv(1024)  # Wait for response from server
+                sent = time.monotonic()  # The heartbeat doubles as a round-trip time probe
+                framing.send_message(self.tcp_sock, b"HEARTBEAT")  # Send a heartbeat message
+                response = self.recv_message(self.tcp_sock)  # Wait for response from server
                 if response == b"ALIVE":  # Server acknowledges the heartbeat
-                    print("Heartbeat acknowledged.")
+                    sample = time.monotonic() - sent
+                    self.rtt = sample if self.rtt is None else self.rtt + (sample - self.rtt) * RTT_EWMA_WEIGHT
+                    print(f"Heartbeat acknowledged. Round trip {sample * 1000:.1f} ms, smoothed {self.rtt * 1000:.1f} ms")
+                elif not response:  # The server closed the connection
+                    raise ConnectionResetError("connection closed by server")
                 else:
                     print("Unexpected heartbeat response.")
-            except (socket.timeout, ConnectionRefusedError):  # Handle connection errors
-                print("Heartbeat failed. Server may be offline.")
-                self.is_recording = False  # Stop recording if the server is unreachable
-                self.is_running = False  # Stop the client
-                return
-            finally:
-                try:
-                    tcp_sock.close()  # Close the socket after sending the heartbeat
-                except:
-                    pass
-            time.sleep(HEARTBEAT_INTERVAL)  # Wait before sending the next heartbeat
+            except OSError:  # Handle connection errors, including timeouts
+                print("Heartbeat failed. Reconnecting to the server...")
+                self.tcp_sock.close()
+                self.tcp_sock = None
+                if self.is_running and not self.tcp_handshake():
+                    print("Server may be offline.")
+                    self.stop()  # Stop the client if the server is unreachable
+                    return
+            self._stopped.wait(HEARTBEAT_INTERVAL)  # Wait before sending the next heartbeat, waking early on stop
 
     """
-    Records audio and sends it to the server as packets
+    Records audio and hands it to the sender thread
     """
     def record_and_send_audio(self):
         print("Starting audio recording...")
-        def callback(indata, frames, time, status):
-            if status:
-                print(f"Input status: {status}")  # Display input status if there's an issue with audio input
-            if not self.is_recording:  # If recording is stopped, exit the callback
-                return
-            # Convert float audio data into 16-bit integer format and then to bytes
-            audio_data = (indata * 32767).astype(np.int16)
-            audio_bytes = audio_data.tobytes()  # Convert the numpy array to raw bytes
-            for i in range(0, len(audio_bytes), BYTES_PER_PACKET):  # Split audio data into packets
-                chunk = audio_bytes[i:i + BYTES_PER_PACKET]  # Get a chunk of the audio data
-                if len(chunk) == BYTES_PER_PACKET:  # Only send full-sized packets
-                    packet = struct.pack(">I", self.sequence_number) + chunk  # Pack the sequence number and audio chunk
-                    try:
-                        self.udp_sock.sendto(packet, (self.server_ip, UDP_SERVER_PORT))  # Send the packet via UDP
-                        self.sequence_number += 1  # Increment the sequence number for the next packet
-                    except Exception as e:
-                        print(f"Error sending packet: {e}")  # Handle any errors that occur during sending
+        self.prepare_batch_send()  # Build the sendmmsg batch before audio starts flowing
+        sender_thread = threading.Thread(target=self.send_audio, daemon=True)  # Thread that packetizes and sends audio
+        sender_thread.start()
         try:
-            with sd.InputStream(samplerate=SAMPLE_RATE, channels=CHANNELS, blocksize=CHUNK_SIZE, callback=callback):
+            # Capture in int16 so PortAudio's native converter does the float to PCM scaling (with clipping) in C
+            with sd.RawInputStream(samplerate=SAMPLE_RATE, channels=CHANNELS, blocksize=CHUNK_SIZE, dtype="int16") as stream:
                 print("Input stream opened.")  # Indicate that the audio input stream is opened
                 while self.is_recording:
-                    sd.sleep(20)  # Sleep briefly between chunks of audio data to avoid high CPU usage
+                    data, overflowed = stream.read(CHUNK_SIZE)  # Blocks until a full packet of audio is available
+                    if overflowed:
+                        self.log("Input overflow, audio was lost before it could be read")
+                    tail = self._capture_tail
+                    if tail - self._capture_head == CAPTURE_SLOTS:  # The sender fell behind, drop the block rather than overwrite unsent audio
+                        self.log("Capture ring full, dropped {} samples", CHUNK_SIZE)
+                        continue
+                    # Encode the 16-bit samples to μ-law straight into the capture block
+                    np.take(ULAW_ENCODE, np.frombuffer(data, dtype=np.uint16), out=self._capture_ring[tail & CAPTURE_MASK])
+                    self._capture_tail = tail + 1  # Publish the block to the sender thread
+                    self._capture_queue.put_nowait(True)  # Wake the sender thread, never blocks
         except Exception as e:
             print(f"InputStream error: {e}")  # Handle any errors that occur while setting up the input stream
             self.is_recording = False  # Stop recording if an error occurs
+        self._capture_queue.put_nowait(False)  # Tell the sender thread that no more audio is coming
+        sender_thread.join()  # Let it send whatever is still in the capture ring
+
+    """
+    Stops recording; the recording thread closes the input stream after its current read
+    """
+    def stop_recording(self):
+        self.is_recording = False
+
+    """
+    Stops the client and wakes the main thread so it can shut everything down
+    """
+    def stop(self):
+        self.is_running = False
+        self.stop_recording()
+        try:
+            self._wakeup_send.send(b"\0")  # Wake the receive thread so it sees is_running is False
+        except OSError:  # Already woken, or the client is shutting down
+            pass
+        self._stopped.set()
+
+    """
+    Sends the audio blocks recorded by the recording thread to the server
+    """
+    def send_audio(self):
+        running = True
+        while running:
+            running = self._capture_queue.get()  # Sleep until the recording thread adds a block
+            while running:
+                try:
+                    running = self._capture_queue.get_nowait()  # Wake-ups for blocks sent in this pass are not needed
+                except queue.Empty:
+                    break
+            head, tail = self._capture_head, self._capture_tail
+            while head < tail:
+                count = min(tail - head, MAX_BATCH)
+                try:
+                    self.send_batch([(head + i) & CAPTURE_MASK for i in range(count)])  # Send the whole batch in one system call
+                except Exception as e:
+                    print(f"Error sending packet: {e}")  # Handle any errors that occur during sending
+                head += count
+                self._capture_head = head  # Hand the sent slots back to the recording thread
 
     """
     Plays back received audio from the jitter buffer
     """
     def play_audio(self):
         print("Starting audio playback...")
-        with sd.OutputStream(samplerate=SAMPLE_RATE, channels=CHANNELS, dtype=np.float32) as stream:
+        # Play in int16 so decoded packets go to PortAudio as-is, with no conversion to float
+        # write() blocks until the device has room for the block, which paces this loop at exactly one packet per packet time
+        played = silent = 0  # Packets of audio and of silence played since the last summary
+        last_report = time.monotonic()  # When the last summary was logged
+        with sd.RawOutputStream(samplerate=SAMPLE_RATE, channels=CHANNELS, blocksize=CHUNK_SIZE, dtype="int16", latency="low") as stream:
             while self.is_running and not self.eot_received:  # Keep playing audio until the client stops or EOT is received
-                seq_num, audio_bytes = self.jitter_buffer.get_packet()  # Retrieve the next packet from the jitter buffer
-                if audio_bytes is None:  # If the buffer is empty, play silence
-                    silence = np.zeros((CHUNK_SIZE, CHANNELS), dtype=np.float32)
-                    stream.write(silence)
-                    print("Playing silence")
-                else:
-                    audio_data = np.frombuffer(audio_bytes, dtype=np.int16).astype(np.float32) / 32767.0  # Normalize the audio
-                    audio_data = np.reshape(audio_data, (-1, CHANNELS))  # Reshape to the correct format
-                    if audio_data.shape[0] < CHUNK_SIZE:  # If the data has fewer samples than expected, pad with silence
-                        audio_data = np.pad(audio_data, ((0, CHUNK_SIZE - audio_data.shape[0]), (0, 0)))
-                    elif audio_data.shape[0] > CHUNK_SIZE:  # If the data has more samples, trim it
-                        audio_data = audio_data[:CHUNK_SIZE]
-                    stream.write(audio_data)  # Play the audio
-                    print(f"Playing packet seq_num: {seq_num}")
-                time.sleep(PLAYBACK_INTERVAL_MS / 1000.0)  # Wait before playing the next packet
+                count = 0
+                while count < PLAYBACK_BATCH:  # Gather every packet the jitter buffer is ready to release
+                    # Copy the next packet from the jitter buffer straight into the batch
+                    seq_num = self.jitter_buffer.read_packet(self._play_buf[count * BYTES_PER_PACKET:(count + 1) * BYTES_PER_PACKET])
+                    if seq_num is None:
+                        break
+                    count += 1
+                if count:
+                    samples = count * CHUNK_SIZE
+                    np.take(ULAW_DECODE, self._play_ulaw[:samples], out=self._play_pcm[:samples])  # Decode the batch back to 16-bit samples
+                    stream.write(self._play_pcm[:samples])  # Play the whole batch in one call
+                    played += count
+                else:  # If the buffer is empty, play silence
+                    stream.write(SILENCE)
+                    silent += 1
+                now = time.monotonic()
+                if now - last_report >= STATS_INTERVAL:
+                    self.log("Played {} packets and {} packets of silence", played, silent)
+                    played = silent = 0
+                    last_report = now
 
     """
     Receives audio packets from the server and adds them to the jitter buffer
@@ -236,18 +508,15 @@ class Client:
         print("Listening for audio packets...")
         while self.is_running:
             try:
-                packet, addr = self.udp_sock.recvfrom(PACKET_SIZE)  # Receive a packet from the server
-                if len(packet) < 4:  # If the packet is too small to contain valid data, skip it
-                    continue
-                seq_num = struct.unpack(">I", packet[:4])[0]  # Extract the sequence number from the packet
-                audio_data = packet[4:]  # Extract the audio data from the packet
-                if seq_num == EOT_SEQ_NUM:  # If the sequence number indicates EOT, stop receiving packets
-                    self.eot_received = True
-                    break
-                if len(audio_data) == BYTES_PER_PACKET:  # Ensure the packet contains the expected amount of audio data
-                    self.jitter_buffer.add_packet(seq_num, audio_data)  # Add the packet to the jitter buffer
-            except socket.timeout:  # If a timeout occurs while waiting for a packet, continue the loop
-                continue
+                for i, length in enumerate(self.receive_batch()):  # Receive a batch of packets from the server
+                    if length < HEADER_SIZE:  # If the packet is too small to contain valid data, skip it
+                        continue
+                    seq_num = HEADER.unpack_from(self._recv_batch.views[i])[0]  # Extract the sequence number from the packet
+                    if seq_num == EOT_SEQ_NUM:  # If the sequence number indicates EOT, stop receiving packets
+                        self.eot_received = True
+                        return
+                    if length == PACKET_SIZE:  # Ensure the packet contains the expected amount of audio data
+                        self.jitter_buffer.add_packet(seq_num, self._recv_batch.views[i][HEADER_SIZE:PACKET_SIZE])  # Add the packet to the jitter buffer
             except Exception as e:
                 print(f"Error receiving packet: {e}")  # Handle any other errors during packet reception
 
@@ -255,9 +524,8 @@ class Client:
     Sends an End of Transmission (EOT) signal to the server to indicate that playback is complete
     """
     def send_eot(self):
-        eot_packet = struct.pack(">I", EOT_SEQ_NUM) + b"\x00" * BYTES_PER_PACKET  # Create an EOT packet
         try:
-            self.udp_sock.sendto(eot_packet, (self.server_ip, UDP_SERVER_PORT))  # Send the EOT packet to the server
+            self.udp_sock.send(EOT_PACKET)  # Send the EOT packet to the server
         except Exception as e:
             print(f"Error sending EOT: {e}")  # Handle any errors during EOT transmission
 
@@ -267,31 +535,52 @@ class Client:
     def start(self):
         if not self.tcp_handshake():  # Perform the TCP handshake with the server
             return  # Exit if handshake fails
+        record_thread = threading.Thread(target=self.record_and_send_audio, daemon=True)  # Thread to record and send audio
+        receive_thread = threading.Thread(target=self.receive_audio, daemon=True)  # Thread to receive audio data
         threads = [
-            threading.Thread(target=self.record_and_send_audio, daemon=True),  # Thread to record and send audio
-            threading.Thread(target=self.receive_audio, daemon=True),  # Thread to receive audio data
+            threading.Thread(target=self.print_log, daemon=True),  # Thread to print messages from the audio threads
+            record_thread,
+            receive_thread,
         ]
         for t in threads:
-            t.start()  # Start the threads for recording and receiving
+            t.start()  # Start the threads for logging, recording and receiving
 
         time.sleep(0.2)  # Allow jitter buffer to prefill before starting playback
 
         playback_thread = threading.Thread(target=self.play_audio, daemon=True)  # Thread for playback
         heartbeat_thread = threading.Thread(target=self.send_heartbeat, daemon=True)  # Thread for sending heartbeat
+        command_thread = threading.Thread(target=self.read_commands, daemon=True)  # Thread that waits for "quit"
         playback_thread.start()
         heartbeat_thread.start()
+        command_thread.start()
 
         try:
-            while self.is_running:
-                if input().strip().lower() == "quit":  # Listen for "quit" to stop the client
-                    self.is_running = False
-                    self.send_eot()  # Send the EOT packet before exiting
-                    break
+            while not self._stopped.wait(0.5):  # Wake up regularly so Ctrl+C is noticed on every platform
+                pass
         except KeyboardInterrupt:
-            self.is_running = False  # Stop the client if interrupted (e.g., Ctrl+C)
-            self.send_eot()  # Ensure EOT is sent on shutdown
+            self.stop()  # Stop the client if interrupted (e.g., Ctrl+C)
 
+        record_thread.join(TIMEOUT)  # Wait for the last recorded packets to be sent
+        self.send_eot()  # Send the EOT packet before exiting
+        receive_thread.join(TIMEOUT)  # stop() has woken it, so it returns straight away
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
         self.udp_sock.close()  # Close the UDP socket when done
+        if self.tcp_sock is not None:  # None if a reconnect was under way
+            self.tcp_sock.close()  # Close the TCP connection to the server
+
+    """
+    Reads commands from the console on its own thread, so a blocking input() never holds up shutdown
+    """
+    def read_commands(self):
+        try:
+            while self.is_running:
+                if input().strip().lower() == "quit":  # Listen for "quit" to stop the client
+                    self.stop()
+                    return
+        except EOFError:  # No console input available, the client runs until interrupted
+            return
 
 """
 Main entry point for the client, parsing command-line arguments and starting the client
@@ -0,0 +1,70 @@
+"""
+Length-prefixed TCP control messages shared by the client and the server.
+
+Every control message (HELLO, HEARTBEAT, WELCOME, ...) is sent as a 4-byte big-endian length followed by the message,
+so messages stay intact in the TCP byte stream.
+"""
+
+# imports
+import struct  # For packing and unpacking the length prefix
+
+# constants
+MSG_LENGTH = struct.Struct(">I")  # Length prefix in front of every TCP control message
+MAX_MESSAGE_SIZE = 1024  # Largest control message either side accepts
+
+"""
+Raised when a peer announces a message larger than MAX_MESSAGE_SIZE. The rest of the stream cannot be trusted after it
+"""
+class MessageTooLarge(OSError):
+    pass
+
+"""
+Sends one length-prefixed control message over a TCP connection
+"""
+def send_message(sock, message):
+    sock.sendall(MSG_LENGTH.pack(len(message)) + message)  # One write, so prefix and message leave in one segment
+
+"""
+Reads exactly `size` bytes from a TCP connection, b"" if the peer closed it first
+"""
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ConnectionResetError("connection closed in the middle of a message")
+            return b""
+        data += chunk
+    return data
+
+"""
+Receives one length-prefixed control message from a TCP connection, b"" if the peer closed it
+"""
+def recv_message(sock):
+    header = recv_exact(sock, MSG_LENGTH.size)
+    if not header:
+        return b""
+    length = MSG_LENGTH.unpack(header)[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise MessageTooLarge(f"message of {length} bytes is too large")
+    message = recv_exact(sock, length)
+    if length and not message:
+        raise ConnectionResetError("connection closed in the middle of a message")
+    return message
+
+"""
+Removes the first complete message from the front of `buffer` (a bytearray), or returns None if it is still arriving
+"""
+def split_message(buffer):
+    if len(buffer) < MSG_LENGTH.size:
+        return None
+    length = MSG_LENGTH.unpack_from(buffer)[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise MessageTooLarge(f"message of {length} bytes is too large")
+    end = MSG_LENGTH.size + length
+    if len(buffer) < end:
+        return None
+    message = bytes(buffer[MSG_LENGTH.size:end])
+    del buffer[:end]
+    return message
@@ -14,62 +14,173 @@ Key features:
 """
 
 # imports
+import os
 import socket
 import threading
+import queue  # For handing TCP connections between the listener and the worker threads
 import time
-import select
+import selectors  # For waiting on the UDP socket (epoll on Linux) with a selector registered once
 import struct
+from collections import deque  # Queue of heartbeat deadlines, in the order they expire
+from concurrent.futures import ThreadPoolExecutor  # Pool of threads for the TCP control messages
+import udp_batch  # Batched UDP receives and sends (recvmmsg/sendmmsg) with fallbacks for other platforms
+import framing  # Length-prefixed TCP control messages, shared with the client
 
 # constants
 TCP_IP = "0.0.0.0"  # IP address to bind for the TCP server
 TCP_PORT = 8888  # Port for the TCP server to listen on
 UDP_IP = "0.0.0.0"  # IP address to bind for the UDP server
 UDP_PORT = 9999  # Port for the UDP server to listen on
-BUFFER_SIZE = 2200  # Size of the buffer for receiving UDP data
+PATH_MTU = 1500  # Largest IP packet the network carries unfragmented, must match the clients' PATH_MTU
+IP_UDP_HEADER_SIZE = 28  # IPv4 (20 bytes) plus UDP (8 bytes) headers in front of every audio packet
+PACKET_SIZE = PATH_MTU - IP_UDP_HEADER_SIZE  # Clients fill one MTU per audio packet
+BUFFER_SIZE = PACKET_SIZE + 1  # Size of the buffer for receiving UDP data, one byte larger so oversized packets reach the clients as such
+RECV_BATCH = 32  # Maximum number of UDP packets read from the kernel in a single recvmmsg call
 MAX_CLIENTS = 10  # Maximum number of clients that can be connected at once
+TCP_WORKERS = 4  # Threads handling complete TCP control messages; the listener reads them, so a slow client never holds one
 TCP_TIMEOUT = 30  # Timeout for TCP client connections in seconds
 HEARTBEAT_TIMEOUT = 120  # Timeout for heartbeat in seconds, after which a client is considered dead
-HEARTBEAT_INTERVAL = 10  # Interval to check the heartbeat of clients
+FINAL_SEND_TIMEOUT = 1  # Seconds allowed for the last reply on a connection that is being closed because of an error
+REPLY_TIMEOUT = 1  # Seconds a reply may take to send, so a client that stops reading cannot hold a worker
+HELLO_PORT = struct.Struct(">I")  # The client's UDP port, right after the 5-byte b"HELLO" tag of a HELLO message
+STATS_INTERVAL = 1.0  # Seconds between summaries of forwarded packets, so nothing is printed per packet
+# Requested UDP receive buffer, overridable with the UDP_RCVBUF_SIZE environment variable; capped by net.core.rmem_max
+UDP_RCVBUF_SIZE = int(os.environ.get("UDP_RCVBUF_SIZE", 4 * 1024 * 1024))
+# Requested UDP send buffer, overridable with the UDP_SNDBUF_SIZE environment variable; capped by net.core.wmem_max
+UDP_SNDBUF_SIZE = int(os.environ.get("UDP_SNDBUF_SIZE", 4 * 1024 * 1024))
+RECEIVER_CPU = os.environ.get("RECEIVER_CPU")  # CPU to pin the UDP receive thread to (Linux), unset to let the scheduler move it
+RECEIVER_RT_PRIORITY = os.environ.get("RECEIVER_RT_PRIORITY")  # SCHED_FIFO priority for the UDP receive thread (Linux, needs root)
 
 """
 data structures for managing clients and heartbeats
 """
 clients = {}  # A dictionary mapping client IPs to (listen_port, target_ip, target_port)
 clients_lock = threading.Lock()  # Lock to protect the clients dictionary from race conditions
-last_heartbeat = {}  # A dictionary mapping client IPs to their last heartbeat time
+routes = {}  # Snapshot for the UDP forwarder: client IP -> (target_ip, target_port), or None until the target registers
+UNREGISTERED = object()  # Returned by routes.get for a sender that is not in the snapshot at all
+last_heartbeat = {}  # A dictionary mapping client IPs to their last heartbeat time (time.monotonic())
+heartbeat_deadlines = deque()  # (deadline, client_ip, heartbeat_time) for every heartbeat, oldest first, so the head expires next
+forward_stats = {}  # Packets forwarded since the last summary: client IP -> count, receive thread only
+ignored_stats = {}  # Packets from unregistered clients since the last summary: client IP -> count, receive thread only
+dropped_stats = {}  # Forwarded packets dropped because the send buffer was full: (target_ip, target_port) -> count, receive thread only
 heartbeat_lock = threading.Lock()  # Lock to protect the heartbeat dictionary from race conditions
+control_connections = set()  # Open TCP control connections, shut down by main on exit so their clients see the server leave
+control_lock = threading.Lock()  # Lock to protect the control_connections set
+tcp_pool = ThreadPoolExecutor(max_workers=TCP_WORKERS)  # Handles complete control messages read by tcp_handshake_listener
+idle_connections = queue.SimpleQueue()  # (tcp_conn, tcp_addr, buffer) handed back by the workers, to wait for their next message
+heartbeat_added = threading.Condition(heartbeat_lock)  # Wakes heartbeat_monitor when a deadline is queued while it has none
 
 """
-Handles a UDP client by forwarding the received data to the appropriate target.
+Publishes a new routes snapshot after clients has changed. Must be called with clients_lock held.
 """
-def handle_client(data, addr):
+def publish_routes():
+    global routes
+    routes = {client_ip: (target_ip, target_port) if target_ip and target_port else None
+              for client_ip, (_, target_ip, target_port) in clients.items()}
+
+"""
+Records a heartbeat from a client and queues the deadline for its next one. Must be called with heartbeat_lock held.
+"""
+def record_heartbeat(client_ip):
+    now = time.monotonic()
+    last_heartbeat[client_ip] = now
+    if not heartbeat_deadlines:  # heartbeat_monitor is waiting for a deadline to appear
+        heartbeat_added.notify()
+    heartbeat_deadlines.append((now + HEARTBEAT_TIMEOUT, client_ip, now))
+
+"""
+Handles a UDP client by queueing the received data in `forward` for the appropriate target.
+"""
+def handle_client(data, addr, forward):
     client_ip = addr[0]  # Get the client's IP address
-    with clients_lock:
-        if client_ip not in clients:
-            print(f"Unregistered client {addr} sent data.")
-            return  # If the client is not registered, ignore the data
-        listen_port, target_ip, target_port = clients[client_ip]  # Get the client info from the dictionary
-    if target_ip and target_port:
+    target = routes.get(client_ip, UNREGISTERED)  # Lock-free lookup in the current snapshot; the batch reuses each IP string, so its hash is cached
+    if target is UNREGISTERED:
+        ignored_stats[client_ip] = ignored_stats.get(client_ip, 0) + 1  # Counted and reported once per STATS_INTERVAL
+        return  # If the client is not registered, ignore the data
+    if target is None:
+        return  # The client's target has not registered yet, so there is nowhere to send the data
+    try:
+        # Queue the UDP data for the target; receive_audio sends the whole batch at once
+        report_forward_errors(forward.add(data, target))
+        forward_stats[client_ip] = forward_stats.get(client_ip, 0) + 1  # Counted and reported once per STATS_INTERVAL
+    except Exception as e:
+        print(f"Error forwarding to {target[0]}:{target[1]}: {e}")
+
+"""
+Prints the packets a forwarding batch failed to send.
+"""
+def report_forward_errors(errors):
+    for target, e in errors:
+        if isinstance(e, BlockingIOError):  # The send buffer is full, a late packet is useless anyway
+            dropped_stats[target] = dropped_stats.get(target, 0) + 1
+        else:
+            print(f"Error forwarding to {target[0]}:{target[1]}: {e}")
+
+"""
+Prints how many packets were forwarded, ignored and dropped since the last summary.
+"""
+def report_stats(dropped):
+    if dropped:
+        print(f"Kernel dropped {dropped} packets, the UDP receive buffer overflowed")
+    for client_ip, count in forward_stats.items():
+        target = routes.get(client_ip)
+        if target:
+            print(f"Forwarded {count} packets from {client_ip} to {target[0]}:{target[1]}")
+        else:  # The client left since
+            print(f"Forwarded {count} packets from {client_ip}")
+    for client_ip, count in ignored_stats.items():
+        print(f"Ignored {count} packets from unregistered client {client_ip}")
+    for (target_ip, target_port), count in dropped_stats.items():
+        print(f"Dropped {count} packets to {target_ip}:{target_port}, the UDP send buffer was full")
+    forward_stats.clear()
+    ignored_stats.clear()
+    dropped_stats.clear()
+
+"""
+Applies the optional RECEIVER_CPU and RECEIVER_RT_PRIORITY settings to the calling thread.
+"""
+def tune_receiver_thread():
+    if RECEIVER_CPU is not None:
+        try:
+            os.sched_setaffinity(0, {int(RECEIVER_CPU)})  # 0 is the calling thread
+            print(f"UDP receiver pinned to CPU {RECEIVER_CPU}")
+        except (AttributeError, ValueError, OSError) as e:  # Not Linux, not a number, or no such CPU
+            print(f"Could not pin the UDP receiver to CPU {RECEIVER_CPU}: {e}")
+    if RECEIVER_RT_PRIORITY is not None:
         try:
-            # Forward the UDP data to the target IP and port
-            server_socket.sendto(data, (target_ip, target_port))
-            print(f"Forwarded packet from {client_ip} to {target_ip}:{target_port}")
-        except Exception as e:
-            print(f"Error forwarding to {target_ip}:{target_port}: {e}")
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(int(RECEIVER_RT_PRIORITY)))
+            print(f"UDP receiver running with SCHED_FIFO priority {RECEIVER_RT_PRIORITY}")
+        except (AttributeError, ValueError, OSError) as e:  # Not Linux, not a number, or not permitted
+            print(f"Could not give the UDP receiver realtime priority: {e}")
 
 """
 Listens for incoming UDP audio packets and forwards them to the appropriate targets.
 """
 def receive_audio():
+    tune_receiver_thread()  # Pin and prioritise this thread if configured
     server_socket.setblocking(False)  # Set the UDP socket to non-blocking mode
+    selector = selectors.DefaultSelector()  # epoll on Linux, so the socket is not handed to the kernel again on every wait
+    selector.register(server_socket, selectors.EVENT_READ)
+    # Preallocated receive buffers, which also count the packets the kernel drops when they overflow
+    batch = udp_batch.ReceiveBatch(server_socket, RECV_BATCH, BUFFER_SIZE, addresses=True, count_drops=True)
+    forward = udp_batch.SendBatch(server_socket, RECV_BATCH)  # Forwarded packets, pointing into the receive buffers
     print("Started receiving UDP audio packets.")
+    last_report = time.monotonic()  # When report_stats last ran
+    last_dropped = 0  # Kernel drop count at the last report
     while True:
         try:
-            # Use select to check for readable data on the socket with a timeout of 1 second
-            readable, _, _ = select.select([server_socket], [], [], 1.0)
-            if server_socket in readable:
-                data, addr = server_socket.recvfrom(BUFFER_SIZE)  # Receive the UDP packet
-                handle_client(data, addr)  # Handle the received data
+            timeout = None  # Sleep until packets arrive, unless counts are waiting to be reported
+            if forward_stats or ignored_stats or dropped_stats or batch.dropped != last_dropped:
+                timeout = max(0, last_report + STATS_INTERVAL - time.monotonic())  # Report them even if traffic stops
+            selector.select(timeout)
+            for i, (length, addr) in enumerate(batch.receive()):  # Receive up to RECV_BATCH queued UDP packets
+                handle_client(batch.views[i][:length], addr, forward)  # Handle the received data
+            report_forward_errors(forward.send())  # Forward the batch before the receive buffers are reused
+            now = time.monotonic()
+            if now - last_report >= STATS_INTERVAL:
+                report_stats(batch.dropped - last_dropped)
+                last_report = now
+                last_dropped = batch.dropped
         except socket.error as e:
             print(f"Error receiving data: {e}")
         except KeyboardInterrupt:
@@ -77,22 +188,32 @@ def receive_audio():
             break
 
 """
-Handles an incoming TCP client connection, processes messages like HELLO, HEARTBEAT, and DISCONNECT.
+Sends a last message on a connection that is about to be closed, ignoring any failure.
 """
-def handle_tcp_client(tcp_conn, tcp_addr):
+def send_final_message(tcp_conn, message):
+    try:
+        tcp_conn.settimeout(FINAL_SEND_TIMEOUT)
+        framing.send_message(tcp_conn, message)
+    except OSError:
+        pass
+
+"""
+Handles one complete message from a TCP control connection. Returns True if the connection stays open.
+"""
+def handle_tcp_message(tcp_conn, tcp_addr, greeted, data):
     try:
-        tcp_conn.settimeout(TCP_TIMEOUT)  # Set the timeout for the TCP connection
-        data = tcp_conn.recv(1024)  # Receive data from the TCP client
         if data.startswith(b"HELLO"):  # If the client sends a HELLO message
             # Parse HELLO: port (4 bytes) + target_ip (string)
-            if len(data) < 9:
+            if len(data) < 5 + HELLO_PORT.size:
                 print(f"Invalid HELLO from {tcp_addr}")
-                tcp_conn.send(b"INVALID")  # Send an INVALID response if the data is too short
-                return
-            client_port = struct.unpack(">I", data[5:9])[0]  # Extract the client port (4 bytes)
-            target_ip = data[9:].decode(errors="ignore")  # Extract the target IP as a string
+                framing.send_message(tcp_conn, b"INVALID")  # Send an INVALID response if the data is too short
+                return False
+            client_port = HELLO_PORT.unpack_from(data, 5)[0]  # Extract the client port (4 bytes) without slicing
+            target_ip = data[5 + HELLO_PORT.size:].decode(errors="ignore")  # Extract the target IP as a string
+            # Only the dictionary updates happen under the lock; replies and prints wait until it is released
             with clients_lock:
-                if len(clients) < MAX_CLIENTS:
+                registered = len(clients) < MAX_CLIENTS
+                if registered:
                     clients[tcp_addr[0]] = (client_port, target_ip, None)  # Register the client
                     # If the target IP is already registered, update the target port
                     if target_ip in clients:
@@ -101,52 +222,152 @@ def handle_tcp_client(tcp_conn, tcp_addr):
                         # Update reverse mapping if the target IP has the client IP as its target
                         if clients[target_ip][1] == tcp_addr[0]:
                             clients[target_ip] = (clients[target_ip][0], tcp_addr[0], client_port)
-                    print(f"Client {tcp_addr[0]}:{client_port} registered, targeting {target_ip}")
-                    tcp_conn.send(b"WELCOME")  # Send a WELCOME message to the client
-                    with heartbeat_lock:
-                        last_heartbeat[tcp_addr[0]] = time.time()  # Update the last heartbeat time for the client
-                else:
-                    print(f"Client limit reached. Rejecting {tcp_addr[0]}")
-                    tcp_conn.send(b"FULL")  # Send a FULL response if the client limit is reached
-        elif data == b"HEARTBEAT":  # If the client sends a HEARTBEAT message
+                    publish_routes()
+                    with heartbeat_lock:  # Still under clients_lock, so heartbeat_monitor cannot evict the new registration
+                        record_heartbeat(tcp_addr[0])  # Registering counts as the client's first heartbeat
+            if not registered:
+                print(f"Client limit reached. Rejecting {tcp_addr[0]}")
+                framing.send_message(tcp_conn, b"FULL")  # Send a FULL response if the client limit is reached
+                return False
+            print(f"Client {tcp_addr[0]}:{client_port} registered, targeting {target_ip}")
+            framing.send_message(tcp_conn, b"WELCOME")  # Send a WELCOME message to the client
+            return True
+        if not greeted:  # Only registered clients may hold a connection open
+            print(f"Expected HELLO from {tcp_addr}")
+            framing.send_message(tcp_conn, b"INVALID")
+            return False
+        if data == b"HEARTBEAT":  # If the client sends a HEARTBEAT message
             with heartbeat_lock:
-                last_heartbeat[tcp_addr[0]] = time.time()  # Update the last heartbeat time
-                tcp_conn.send(b"ALIVE")  # Send an ALIVE response to the client
-                print(f"Heartbeat from {tcp_addr[0]}")
-        elif data == b"DISCONNECT":  # If the client sends a DISCONNECT message
+                record_heartbeat(tcp_addr[0])  # Update the last heartbeat time
+            framing.send_message(tcp_conn, b"ALIVE")  # Send an ALIVE response to the client
+            print(f"Heartbeat from {tcp_addr[0]}")
+            return True
+        if data == b"DISCONNECT":  # If the client sends a DISCONNECT message
             with clients_lock:
                 clients.pop(tcp_addr[0], None)  # Remove the client from the clients list
+                publish_routes()
             with heartbeat_lock:
                 last_heartbeat.pop(tcp_addr[0], None)  # Remove the client's heartbeat entry
-            tcp_conn.send(b"BYE")  # Send a BYE response to the client
+            framing.send_message(tcp_conn, b"BYE")  # Send a BYE response to the client
             print(f"Client {tcp_addr[0]} disconnected.")
-        else:
-            print(f"Invalid message from {tcp_addr}")
-            tcp_conn.send(b"INVALID")  # Send an INVALID response if the message is unrecognized
-    except socket.timeout:
+            return False
+        print(f"Invalid message from {tcp_addr}")
+        framing.send_message(tcp_conn, b"INVALID")  # Send an INVALID response if the message is unrecognized
+        return False
+    except socket.timeout:  # The client stopped reading its replies
         print(f"TCP timeout from {tcp_addr}")
-        tcp_conn.send(b"TIMEOUT")  # Send a TIMEOUT message if the TCP connection times out
+        send_final_message(tcp_conn, b"TIMEOUT")  # Send a TIMEOUT message if the TCP connection times out
     except Exception as e:
         print(f"Error handling TCP client: {e}")
-        tcp_conn.send(b"ERROR")  # Send an ERROR response in case of other exceptions
-    finally:
-        tcp_conn.close()  # Always close the TCP connection when done
+        send_final_message(tcp_conn, b"ERROR")  # Send an ERROR response in case of other exceptions
+    return False
 
 """
-Listens for incoming TCP connections and spawns threads to handle them.
+Prints why a TCP control connection is being dropped and sends the client a last reply. Always closes the connection.
+"""
+def reject_tcp_connection(tcp_conn, tcp_addr, reason, reply):
+    print(f"{reason} from {tcp_addr}")
+    send_final_message(tcp_conn, reply)
+    return False
+
+"""
+Closes a TCP control connection and forgets it.
+"""
+def close_control_connection(tcp_conn):
+    with control_lock:
+        control_connections.discard(tcp_conn)
+    tcp_conn.close()
+
+"""
+Runs a control connection handler on a pool thread, then hands the connection back to the listener or closes it.
+"""
+def serve_tcp_connection(wakeup_send, handler, tcp_conn, tcp_addr, buffer, *args):
+    if handler(tcp_conn, tcp_addr, *args):
+        idle_connections.put((tcp_conn, tcp_addr, buffer))
+        try:
+            wakeup_send.send(b"\0")  # Wake the listener so it watches the connection again
+        except OSError:  # The listener's wake-up buffer is full, it is awake already
+            pass
+    else:
+        close_control_connection(tcp_conn)
+
+"""
+Waits for the next complete message on a TCP control connection, or passes one that has already arrived to the pool.
+"""
+def watch_tcp_connection(selector, wakeup_send, tcp_conn, tcp_addr, greeted, deadline, buffer):
+    try:
+        data = framing.split_message(buffer)
+    except framing.MessageTooLarge:  # The stream cannot be trusted after an oversized length prefix
+        tcp_pool.submit(serve_tcp_connection, wakeup_send, reject_tcp_connection, tcp_conn, tcp_addr, buffer,
+                        "Oversized message", b"INVALID")
+        return
+    if data is None:  # Still arriving, keep collecting it without holding a worker
+        selector.register(tcp_conn, selectors.EVENT_READ, (tcp_addr, greeted, deadline, buffer))
+    else:
+        tcp_pool.submit(serve_tcp_connection, wakeup_send, handle_tcp_message, tcp_conn, tcp_addr, buffer, greeted, data)
+
+"""
+Listens for incoming TCP connections and reads their messages with a selector, handing complete ones to tcp_pool.
 """
 def tcp_handshake_listener():
     tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Rebind straight after a restart, despite connections in TIME_WAIT
     tcp_socket.bind((TCP_IP, TCP_PORT))  # Bind the TCP socket to the specified IP and port
     tcp_socket.listen(5)  # Start listening for incoming connections (maximum 5 in the queue)
+    wakeup_recv, wakeup_send = socket.socketpair()  # Written by the workers when they hand a connection back
+    wakeup_send.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(tcp_socket, selectors.EVENT_READ)
+    selector.register(wakeup_recv, selectors.EVENT_READ)
     print(f"TCP server listening on {TCP_IP}:{TCP_PORT}...")
-    try:
-        while True:
-            tcp_conn, tcp_addr = tcp_socket.accept()  # Accept an incoming TCP connection
-            threading.Thread(target=handle_tcp_client, args=(tcp_conn, tcp_addr)).start()  # Handle the connection in a separate thread
-    except KeyboardInterrupt:
-        print("Shutting down TCP listener...")
-        tcp_socket.close()  # Close the TCP socket when the server is interrupted
+    while True:
+        now = time.monotonic()
+        timeout = None  # Seconds until the next connection expires, None if there are none
+        for key in list(selector.get_map().values()):
+            if key.data is None:  # The listening socket or the wake-up socket
+                continue
+            tcp_addr, greeted, deadline, buffer = key.data
+            if deadline <= now:  # No complete message in time
+                selector.unregister(key.fileobj)
+                tcp_pool.submit(serve_tcp_connection, wakeup_send, reject_tcp_connection, key.fileobj, tcp_addr, buffer,
+                                "TCP timeout", b"TIMEOUT")
+            elif timeout is None or deadline - now < timeout:
+                timeout = deadline - now
+        events = selector.select(timeout)
+        now = time.monotonic()
+        for key, _ in events:
+            if key.fileobj is tcp_socket:
+                try:
+                    tcp_conn, tcp_addr = tcp_socket.accept()  # Accept an incoming TCP connection
+                except OSError:  # The client gave up before it was accepted
+                    continue
+                try:
+                    tcp_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send the short replies (WELCOME, ALIVE, BYE) immediately
+                except OSError:  # The client already reset the connection; its first read will fail and close it
+                    pass
+                tcp_conn.settimeout(REPLY_TIMEOUT)  # Only bounds the replies, reads happen once data is already waiting
+                with control_lock:
+                    control_connections.add(tcp_conn)
+                selector.register(tcp_conn, selectors.EVENT_READ, (tcp_addr, False, now + TCP_TIMEOUT, bytearray()))  # HELLO must arrive within TCP_TIMEOUT
+            elif key.fileobj is wakeup_recv:
+                wakeup_recv.recv(4096)
+                while not idle_connections.empty():
+                    tcp_conn, tcp_addr, buffer = idle_connections.get()
+                    # Between heartbeats the connection may sit idle for a while
+                    watch_tcp_connection(selector, wakeup_send, tcp_conn, tcp_addr, True, now + HEARTBEAT_TIMEOUT, buffer)
+            else:  # Data arrived on an open connection
+                tcp_conn = key.fileobj
+                tcp_addr, greeted, deadline, buffer = key.data
+                try:
+                    chunk = tcp_conn.recv(framing.MAX_MESSAGE_SIZE)  # Returns at once, the selector saw data waiting
+                except OSError:
+                    chunk = b""
+                selector.unregister(tcp_conn)
+                if not chunk:  # The client closed or reset the connection
+                    close_control_connection(tcp_conn)
+                    continue
+                buffer += chunk
+                watch_tcp_connection(selector, wakeup_send, tcp_conn, tcp_addr, greeted, deadline, buffer)
 
 """
 Monitors client heartbeats and disconnects clients that haven't sent a heartbeat in time.
@@ -154,24 +375,45 @@ Monitors client heartbeats and disconnects clients that haven't sent a heartbeat
 def heartbeat_monitor():
     while True:
         try:
-            time.sleep(HEARTBEAT_INTERVAL)  # Wait for the next heartbeat interval
-            current_time = time.time()  # Get the current time
-            to_remove = []  # List of clients to remove due to timeout
-            with heartbeat_lock:
-                for client_ip, last_time in last_heartbeat.items():
-                    if current_time - last_time > HEARTBEAT_TIMEOUT:  # If the client's heartbeat has timed out
-                        to_remove.append(client_ip)  # Mark the client for removal
-            with clients_lock:
-                for client_ip in to_remove:
-                    clients.pop(client_ip, None)  # Remove the client from the clients list
-                    print(f"Client {client_ip} timed out.")
             with heartbeat_lock:
-                for client_ip in to_remove:
-                    last_heartbeat.pop(client_ip, None)  # Remove the client's heartbeat entry
+                while True:
+                    if not heartbeat_deadlines:
+                        heartbeat_added.wait()  # Nothing to watch until a client registers
+                        continue
+                    deadline, client_ip, heartbeat_time = heartbeat_deadlines[0]
+                    if last_heartbeat.get(client_ip) != heartbeat_time:  # Superseded by a newer heartbeat, or the client left
+                        heartbeat_deadlines.popleft()
+                        continue
+                    delay = deadline - time.monotonic()
+                    if delay > 0:
+                        heartbeat_added.wait(delay)  # Sleep until the deadline; later heartbeats only queue later deadlines
+                        continue
+                    heartbeat_deadlines.popleft()
+                    break
+            # Same lock order as the HELLO handler; re-check in case the client registered or sent a heartbeat meanwhile
+            with clients_lock, heartbeat_lock:
+                if last_heartbeat.get(client_ip) != heartbeat_time:
+                    continue
+                del last_heartbeat[client_ip]  # Remove the client's heartbeat entry
+                clients.pop(client_ip, None)  # Remove the client from the clients list
+                publish_routes()
+            print(f"Client {client_ip} timed out.")
         except KeyboardInterrupt:
             print("Shutting down heartbeat monitor...")
             break
 
+"""
+Shuts down every open TCP control connection, so clients see the server go away.
+"""
+def close_control_connections():
+    with control_lock:
+        connections = list(control_connections)
+    for tcp_conn in connections:
+        try:
+            tcp_conn.shutdown(socket.SHUT_RDWR)  # Tell the client straight away instead of leaving it to time out
+        except OSError:  # Already closed
+            pass
+
 """
 Main entry point for the server. Starts the UDP receiver, TCP listener, and heartbeat monitor.
 """
@@ -179,6 +421,11 @@ def main():
     global server_socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Create a UDP socket
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow reuse of address
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF_SIZE)  # Room to absorb bursts of audio packets
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SNDBUF_SIZE)  # Room to queue forwarded bursts instead of dropping them
+    # The kernel silently caps both sizes, so report what was actually granted
+    print(f"UDP buffers: send {server_socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)} bytes, "
+          f"receive {server_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes")
     server_socket.bind(("0.0.0.0", UDP_PORT))  # Bind the UDP socket to the specified IP and port
     print(f"UDP server listening on {UDP_IP}:{UDP_PORT}...")
     try:
@@ -187,6 +434,9 @@ def main():
         receive_audio()  # Start receiving UDP audio packets
     except KeyboardInterrupt:
         print("Shutting down server...")
+    finally:
+        tcp_pool.shutdown(wait=False, cancel_futures=True)  # Drop queued control messages; running ones finish within REPLY_TIMEOUT
+        close_control_connections()
         server_socket.close()  # Close the UDP socket when the server is interrupted
 
 if __name__ == "__main__":
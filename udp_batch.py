@@ -0,0 +1,250 @@
+"""
+Batched UDP I/O shared by the client and the server.
+
+sendmmsg(2) and recvmmsg(2) move a whole batch of UDP packets to or from the kernel in one system call. They only exist
+on Linux; everywhere else HAVE_SENDMMSG / HAVE_RECVMMSG are False and the helpers here fall back to sending and
+receiving the packets one at a time.
+"""
+
+# imports
+import ctypes  # For calling sendmmsg and recvmmsg from the C library
+import errno  # For recognising the C error numbers returned by recvmmsg
+import os  # For turning C error numbers into error messages
+import socket  # For the fallback socket calls and formatting addresses
+import struct  # For reading the drop counter out of recvmmsg's control messages
+import sys  # For checking which platform we are on
+
+"""
+libc bindings, None where the platform does not provide them
+"""
+try:
+    _libc = ctypes.CDLL(None, use_errno=True) if sys.platform.startswith("linux") else None
+    _sendmmsg = _libc.sendmmsg if _libc is not None else None
+    _recvmmsg = _libc.recvmmsg if _libc is not None else None
+except (OSError, AttributeError):
+    _sendmmsg = _recvmmsg = None
+HAVE_SENDMMSG = _sendmmsg is not None  # True if packets can be sent in batches
+HAVE_RECVMMSG = _recvmmsg is not None  # True if packets can be received in batches
+SO_RXQ_OVFL = 40  # Linux socket option attaching the socket's dropped-packet count to received packets (not exported by the socket module)
+CMSG_HEADER = struct.Struct("@Nii")  # struct cmsghdr: cmsg_len, cmsg_level, cmsg_type
+DROP_COUNT = struct.Struct("@I")  # The SO_RXQ_OVFL counter that follows the header
+
+"""
+ctypes mirrors of the C structures used by sendmmsg and recvmmsg
+"""
+class IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(IoVec)), ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr), ("msg_len", ctypes.c_uint)]
+
+class SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_ubyte * 2),  # Port in network byte order
+        ("sin_addr", ctypes.c_ubyte * 4), ("sin_zero", ctypes.c_ubyte * 8),
+    ]
+
+if HAVE_SENDMMSG:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+if HAVE_RECVMMSG:
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+"""
+Returns the memory address of a bytearray, for pointing iovecs into it. The bytearray must never be resized
+"""
+def buffer_address(buf):
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+"""
+Raises the OSError for the error number left behind by the last failed C call
+"""
+def raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+"""
+Hands msgs[0:count] to the kernel with sendmmsg and returns how many packets were sent
+"""
+def send_messages(sock, msgs, count):
+    sent = 0
+    while sent < count:
+        n = _sendmmsg(sock.fileno(), ctypes.byref(msgs[sent]), count - sent, 0)
+        if n < 0:
+            raise_errno()
+        sent += n
+    return sent
+
+"""
+Preallocated storage for receiving a batch of packets from a non-blocking UDP socket
+"""
+class ReceiveBatch:
+
+    """
+    initialization function
+    """
+    def __init__(self, sock, size, buffer_size, addresses=False, count_drops=False):
+        self.sock = sock  # Socket to read from, must be non-blocking
+        self.size = size  # Most packets read per call
+        self.addresses = addresses  # Whether receive() also reports where each packet came from
+        self.dropped = 0  # Packets dropped by the kernel so far, only counted with count_drops
+        self.controls = None  # Control message buffers for the drop counter, None when not counting
+        self.buf = bytearray(size * buffer_size)  # One buffer_size slot per packet
+        self.views = [memoryview(self.buf)[i * buffer_size:(i + 1) * buffer_size] for i in range(size)]  # One view per slot
+        self.msgs = None  # mmsghdr array for recvmmsg, None when recvmmsg is unavailable
+        if not HAVE_RECVMMSG:
+            return
+        base = buffer_address(self.buf)
+        self.iov = (IoVec * size)()
+        self.names = (SockAddrIn * size)()  # Filled in by the kernel with each packet's source address
+        # The first 8 bytes of each sockaddr_in (family, port and IP) read as one integer, a cheap key for address_cache
+        self.name_keys = (ctypes.c_uint64 * (2 * size)).from_buffer(self.names)
+        self.address_cache = {}  # (ip, port) tuple for every name_keys value seen so far, so each is only decoded once
+        self.msgs = (MMsgHdr * size)()
+        for i in range(size):
+            self.iov[i].iov_base = base + i * buffer_size  # Each packet lands in its own slot
+            self.iov[i].iov_len = buffer_size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self.iov[i])
+            hdr.msg_iovlen = 1
+            if addresses:
+                hdr.msg_name = ctypes.addressof(self.names[i])
+        if count_drops:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)  # Have the kernel report its drop count with each packet
+            except OSError:  # Not supported by this kernel, leave dropped at 0
+                return
+            self.control_size = socket.CMSG_SPACE(DROP_COUNT.size)
+            self.controls = bytearray(size * self.control_size)
+            control_base = buffer_address(self.controls)
+            for i in range(size):
+                self.msgs[i].msg_hdr.msg_control = control_base + i * self.control_size
+
+    """
+    Reads every packet that is already queued, up to size, and returns their lengths
+    """
+    def receive(self):
+        if self.msgs is None:  # No recvmmsg on this platform, read packets one at a time until none are left
+            packets = []
+            while len(packets) < self.size:
+                try:
+                    if self.addresses:
+                        packets.append(self.sock.recvfrom_into(self.views[len(packets)]))
+                    else:
+                        packets.append(self.sock.recv_into(self.views[len(packets)]))
+                except BlockingIOError:
+                    break
+            return packets
+        if self.addresses:
+            for i in range(self.size):
+                self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(SockAddrIn)  # Value-result field, reset before every call
+        if self.controls is not None:
+            for i in range(self.size):
+                self.msgs[i].msg_hdr.msg_controllen = self.control_size  # Value-result field, reset before every call
+        n = _recvmmsg(self.sock.fileno(), self.msgs, self.size, socket.MSG_DONTWAIT, None)
+        if n < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EINTR):  # Nothing queued after all
+                return []
+            raise_errno()
+        if self.controls is not None and self.msgs[n - 1].msg_hdr.msg_controllen:
+            # The counter is cumulative, so the newest packet's copy is the only one worth reading
+            offset = (n - 1) * self.control_size
+            _, level, kind = CMSG_HEADER.unpack_from(self.controls, offset)
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                self.dropped = DROP_COUNT.unpack_from(self.controls, offset + socket.CMSG_LEN(0))[0]
+        if not self.addresses:
+            return [self.msgs[i].msg_len for i in range(n)]
+        packets = []
+        for i in range(n):
+            key = self.name_keys[2 * i]
+            address = self.address_cache.get(key)
+            if address is None:  # First packet from this address, decode it
+                if len(self.address_cache) >= 1024:  # Forget addresses that are no longer in use
+                    self.address_cache.clear()
+                name = self.names[i]
+                address = (socket.inet_ntoa(bytes(name.sin_addr)), name.sin_port[0] << 8 | name.sin_port[1])
+                self.address_cache[key] = address
+            packets.append((self.msgs[i].msg_len, address))  # The same tuple, and IP string, is returned every time
+        return packets
+
+"""
+Preallocated mmsghdr array for sending up to `size` packets with one sendmmsg call
+"""
+class SendBatch:
+
+    """
+    initialization function
+    """
+    def __init__(self, sock, size):
+        self.sock = sock  # Socket to send from
+        self.size = size  # Most packets queued per batch
+        self.packets = []  # (data, address) of every queued packet
+        self.sockaddrs = {}  # Encoded sockaddr_in for every address seen so far, so each is only encoded once
+        self.msgs = None  # mmsghdr array for sendmmsg, None when sendmmsg is unavailable
+        if not HAVE_SENDMMSG:
+            return
+        self.iov = (IoVec * size)()
+        self.names = (SockAddrIn * size)()  # Destination address of each packet
+        self.msgs = (MMsgHdr * size)()
+        for i in range(size):
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.names[i])
+            hdr.msg_namelen = ctypes.sizeof(SockAddrIn)
+            hdr.msg_iov = ctypes.pointer(self.iov[i])
+            hdr.msg_iovlen = 1
+
+    """
+    Queues `data` to be sent to `address`, sending the batch straight away once it is full
+    """
+    def add(self, data, address):
+        if self.msgs is not None:
+            i = len(self.packets)
+            sockaddr = self.sockaddrs.get(address)
+            if sockaddr is None:
+                if len(self.sockaddrs) >= 1024:  # Forget addresses that are no longer in use
+                    self.sockaddrs.clear()
+                ip = socket.inet_aton(address[0])
+                sockaddr = bytes(SockAddrIn(socket.AF_INET, (ctypes.c_ubyte * 2)(address[1] >> 8, address[1] & 0xFF),
+                                            (ctypes.c_ubyte * 4).from_buffer_copy(ip)))
+                self.sockaddrs[address] = sockaddr
+            ctypes.memmove(ctypes.addressof(self.names[i]), sockaddr, len(sockaddr))
+            # Point at the data, no copy; an empty datagram has no buffer to point at
+            self.iov[i].iov_base = ctypes.addressof(ctypes.c_char.from_buffer(data)) if data else None
+            self.iov[i].iov_len = len(data)
+        self.packets.append((data, address))
+        if len(self.packets) == self.size:
+            return self.send()
+        return []
+
+    """
+    Sends every queued packet and returns (address, error) for those that could not be sent
+    """
+    def send(self):
+        errors = []
+        if self.msgs is None:  # No sendmmsg on this platform, send the packets one at a time
+            for data, address in self.packets:
+                try:
+                    self.sock.sendto(data, address)
+                except OSError as e:
+                    errors.append((address, e))
+        else:
+            sent = 0
+            while sent < len(self.packets):  # The kernel may accept fewer packets than requested, resubmit the rest
+                n = _sendmmsg(self.sock.fileno(), ctypes.byref(self.msgs[sent]), len(self.packets) - sent, 0)
+                if n < 0:  # The packet at `sent` failed
+                    err = ctypes.get_errno()
+                    errors.append((self.packets[sent][1], OSError(err, os.strerror(err))))
+                    sent += 1
+                else:
+                    sent += n
+        self.packets.clear()
+        return errors